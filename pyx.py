@@ -2,14 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
 import sys
 import warnings
+import threading
 import time as t
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pyxelate import Pyxelate
-from numpy import uint8
 from skimage import io
-from skimage import transform
+from PIL import Image
+from joblib import Parallel, delayed, effective_n_jobs
 
 
 def parse_arguments():
@@ -47,7 +52,7 @@ def parse_arguments():
     )
     parser.add_argument(
         '-r', '--regenerate_palette',
-        required=False, metavar='bool', type=bool, nargs='?',
+        required=False, metavar='bool', type=str_as_bool, nargs='?',
         default=True, help='''Regenerate the palette for each image.
         Defaults to True.'''
     )
@@ -57,6 +62,21 @@ def parse_arguments():
         help='''Sets the random state of the Bayesian Gaussian Mixture.
         Defaults to 0.'''
     )
+    parser.add_argument(
+        '-q', '--quantizer',
+        required=False, metavar='bgmm|kmeans', type=str, default='bgmm',
+        nargs='?', choices=Pyxelate.QUANTIZERS,
+        help='''The model used for learning the palette, either a
+        Bayesian Gaussian Mixture or a faster mini-batch K-means.
+        Defaults to bgmm.'''
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        required=False, metavar='int', type=int, default=-1, nargs='?',
+        help='''The number of images converted in parallel, negative
+        values count back from the number of CPU cores. Defaults to -1,
+        using all cores.'''
+    )
     parser.add_argument(
         '-i', '--input',
         required=False, metavar='path', type=str, default='', nargs='?',
@@ -85,35 +105,32 @@ def str_as_bool(val):
     return True
 
 
-# Exclude hidden files and directories
+# Files that were excluded from the list
 f_excluded = 0
 
-def exclude_hidden(elm):
+def scan_tree(path):
     global f_excluded
-    if not any(i.startswith('.') for i in elm.parts):
-        return elm
-    f_excluded += 1
-    return False
-
-
- # Exclude directories and files without extension
-def with_extension(elm):
-    global f_excluded
-    if elm.is_file() and '.' in elm.name:
-        return elm
-    f_excluded += 1
-    return False
+    # DirEntry caches the type of the file, so no extra stat is needed
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # Exclude hidden files and directories
+            if entry.name.startswith('.'):
+                f_excluded += 1
+            # Exclude directories, but get the files inside them
+            elif entry.is_dir(follow_symlinks=False):
+                f_excluded += 1
+                yield from scan_tree(entry.path)
+            # Exclude files without extension
+            elif entry.is_file() and '.' in entry.name:
+                yield Path(entry.path)
+            else:
+                f_excluded += 1
 
 
 def get_file_list(path):
     path = Path(path)
     if path.is_dir():
-        # Get all files and directories
-        tree = list(path.glob('**/*'))
-        # Filter files and directories
-        tree = list(filter(exclude_hidden, tree))
-        file_names = list(filter(with_extension, tree))
-        return file_names
+        return list(scan_tree(path))
     elif path.is_file() and '.' in path.name:
         return [path]
     else:
@@ -121,43 +138,62 @@ def get_file_list(path):
         sys.exit(1)
 
 
-def parse_path(file):
+def parse_path(file, input_root):
+    # The input root is the same for all files, so it is passed by the caller
     f_name, f_ext = str(file).rsplit('.', 1)
-    re = str(Path(args.input))
-    if re == '.':
+    if input_root == '.':
         f_name = '/' + f_name
     try:
         f_path, f_name = f_name.rsplit('/', 1)
     except ValueError:
         f_path = ""
-    if re == str(file):
+    if input_root == str(file):
         f_path = ""
-    f_path = f_path.replace(re, "")
+    f_path = f_path.replace(input_root, "")
     f_path += '/' if f_path else ''
     return [f_path, f_name, f_ext]
 
 
-# Define CLI colors and create functions
-def style_def(func, ansi):
-    exec(f'''def {func}(input):
-        return "{ansi}" + str(input) + "\u001b[0m"
-    ''', globals())
+# Define CLI colors and their functions
+c_green = '\u001b[32m'
+c_red = '\u001b[31m'
+c_mag = '\u001b[35m'
+c_dim = '\u001b[37;2m'
+c_reset = '\u001b[0m'
+
+def green(input):
+    return f"{c_green}{input}{c_reset}"
 
-style_def('green', '\u001b[32m')
-style_def('red', '\u001b[31m')
-style_def('mag', '\u001b[35m')
-style_def('dim', '\u001b[37;2m')
+def red(input):
+    return f"{c_red}{input}{c_reset}"
+
+def mag(input):
+    return f"{c_mag}{input}{c_reset}"
+
+def dim(input):
+    return f"{c_dim}{input}{c_reset}"
 
 
 # Status bar logic
 cur_file = 0
 warn_cnt = 0
 err_cnt = 0
-time_img = []
 avg_last_vals = 10
+# Times of the last images and their sum for the moving average
+time_img = deque(maxlen=avg_last_vals)
+time_sum = 0.
+workers = 1
+t_start = t.time()
 t_up = '\x1b[1A'
 t_erase = '\x1b[2K'
 bar_rmv = '\n' + t_erase + t_up + t_erase
+# The empty part of the bar is sliced from this, instead of rebuilding it
+bar_dash = dim("-")
+bar_dashes = bar_dash * 50
+bar_sep = dim(" | ")
+# The remaining time of the last drawn file count
+bar_file = None
+bar_remaining = ""
 
 def sec_to_time(sec):
     n, m, s = 0, 0, 0
@@ -166,25 +202,30 @@ def sec_to_time(sec):
     return f"{h:d}:{m:02d}:{s:02d}"
 
 def bar_redraw(last=False):
-    t_pass = round(t.process_time())
+    global bar_file, bar_remaining
+    t_pass = round(t.time() - t_start)
     i_cur = cur_file
     # Print bar
     percent = round(i_cur / all_files * 100, 1)
     p_int = round(i_cur / all_files * 100) // 2
-    b = "[ " + "•" * (p_int) + dim("-") * (50 - p_int) + " ] "
+    b = "[ " + "•" * (p_int) + bar_dashes[:len(bar_dash) * (50 - p_int)] + " ] "
     b += str(percent) + " %"
     print(b)
     # Print status
-    r = "Done " + green(str(i_cur)) + '/' + str(all_files) + dim(" | ")
+    r = "Done " + green(str(i_cur)) + '/' + str(all_files) + bar_sep
     if args.warnings:
-        r += "Warnings: " + mag(str(warn_cnt)) + dim(" | ")
-    r += "Errors: " + red(str(err_cnt)) + dim(" | ")
-    r += "Elapsed: " + sec_to_time(t_pass) + dim(" | ") + "Remaining: "
+        r += "Warnings: " + mag(str(warn_cnt)) + bar_sep
+    r += "Errors: " + red(str(err_cnt)) + bar_sep
+    r += "Elapsed: " + sec_to_time(t_pass) + bar_sep + "Remaining: "
     # Remaining time. Averaging requires at least 1 value
     if len(time_img) > 0 and not last:
-        t_avg = sum(time_img) / len(time_img)
-        rem = round(t_avg * (all_files - i_cur))
-        r += sec_to_time(rem)
+        # It only changes when another file is done
+        if bar_file != i_cur:
+            t_avg = time_sum / len(time_img)
+            rem = round(t_avg * (all_files - i_cur) / workers)
+            bar_remaining = sec_to_time(rem)
+            bar_file = i_cur
+        r += bar_remaining
     else:
         r += "Calculating..." if not last else sec_to_time(0)
     # Adding escape codes depending on the passed argument
@@ -196,19 +237,218 @@ def bar_redraw(last=False):
     print(r)
 
 
-def print_warn(warn):
+# The file name defaults to the one of the current result
+def print_warn(warn, file=None):
     if str(warn) and args.warnings:
-        re = "/".join([o_path, o_base, f_name]) + '.' + f_ext
+        file = file or f_name + '.' + f_ext
+        re = "/".join([o_path, o_base, file])
         warn = str(warn).replace(re, "").strip().capitalize()
         print(bar_rmv + mag("\tWarning: ") + warn)
-        bar_redraw()
 
-def print_err(err):
+def print_err(err, file=None):
     if str(err):
-        re = "/".join([o_path, o_base, f_name]) + '.' + f_ext
+        file = file or f_name + '.' + f_ext
+        re = "/".join([o_path, o_base, file])
         err = str(err).replace(re, "").strip().capitalize()
         print(bar_rmv + red("\tError: ") + err)
-        bar_redraw()
+
+# Pyxelate instance of the serial path, it is only created once so that
+# the palette can be reused when regenerate_palette is False.
+# Loky workers get a new copy of the globals with every task, so there it
+# is created for every image, which is fine as each image gets its own
+# palette on the parallel path anyway
+p = None
+
+def record_warning(message, category, filename, lineno, file=None, line=None):
+    """Add the message of a warning to the list of the current thread,
+    or show it as usual if the thread is not recording"""
+    warns = getattr(threading.current_thread(), "warns", None)
+    if warns is None:
+        record_warning.show_warning(message, category, filename, lineno,
+            file, line)
+        return
+    message = str(message)
+    if message and message not in warns:
+        warns.append(message)
+
+def record_warnings(warns, func, *args):
+    """Call the function, collecting the messages of its warnings in warns
+    instead of printing them. Repeated messages are only kept once"""
+    # catch_warnings swaps the hooks of the whole process, so a warning from
+    # the background save thread would end up in the list of the image that
+    # is converted at the same time.
+    # The list is kept on the thread instead, and the hook is installed on
+    # the first call, as loky workers do not run the main block. They also
+    # get a new copy of this module with every task, so the installed hook
+    # is recognized by the original one it keeps, not by its identity
+    if not hasattr(warnings.showwarning, "show_warning"):
+        record_warning.show_warning = warnings.showwarning
+        warnings.showwarning = record_warning
+        warnings.simplefilter("always")
+    thread = threading.current_thread()
+    thread.warns = warns
+    try:
+        return func(*args)
+    finally:
+        thread.warns = None
+
+def read_image(image_file):
+    """Read an image, returns None if the file format is not supported"""
+    # The file format must be supported by skimage
+    try:
+        return io.imread(image_file)
+    except ValueError:
+        return None
+
+def prefetch_image(image_file):
+    """Read the raw file, so that decoding it later is not waiting for the disk"""
+    # Decoding stays in the main thread, as skimage changes the warning
+    # filters of the whole process while reading an image
+    try:
+        image_file.read_bytes()
+    except OSError:
+        pass
+
+def upscale(pixels, scaling):
+    """Scale the pixels up if so requested"""
+    # The factor is an integer, so repeating pixels is an exact
+    # nearest neighbor upscale that also keeps the dtype.
+    # Columns are repeated while the image is still small, so the only
+    # pass over the full sized image copies whole rows
+    if scaling > 1:
+        pixels = np.repeat(np.repeat(pixels, scaling, axis=1), scaling, axis=0)
+    return pixels
+
+def to_image(pyxelated, scaling):
+    """Create an upscaled, paletted image from the few colors of the pixel
+    art, every pixel is stored as a single byte instead of RGB values"""
+    height, width, depth = pyxelated.shape
+    # Transparency in palettes is dropped by many readers, keep it as RGBA
+    if depth == 4:
+        return Image.fromarray(upscale(pyxelated, scaling))
+    # Pack the channels of each pixel into a single number
+    channels = pyxelated.astype(np.uint32)
+    codes = channels[:, :, 0] << 16 | channels[:, :, 1] << 8 | channels[:, :, 2]
+    colors, labels = np.unique(codes, return_inverse=True)
+    if len(colors) > 256:
+        return Image.fromarray(upscale(pyxelated, scaling))
+
+    labels = labels.reshape(height, width).astype(np.uint8)
+    image = Image.fromarray(upscale(labels, scaling))
+    palette = np.stack((colors >> 16, colors >> 8, colors), axis=1) & 255
+    image.putpalette(palette.astype(np.uint8).ravel().tolist())
+    return image
+
+def convert_image(image, args, warns, errs):
+    """Pyxelate and upscale an image, returns None on errors"""
+    global p
+    # Height and width are getting set per image, this are just placeholders
+    if p is None:
+        p = Pyxelate(1, 1, color=args.colors, dither=args.dither,
+            alpha=args.alpha, regenerate_palette=args.regenerate_palette,
+            random_state=args.random_state, quantizer=args.quantizer)
+
+    # Get image dimensions
+    height, width, _ = image.shape
+
+    # Apply the dimensions to Pyxelate
+    p.height = height // args.factor
+    p.width = width // args.factor
+
+    try:
+        pyxelated = record_warnings(warns, p.convert, image)
+    except IndexError as e:
+        # When the file is not an image just move to the next file
+        errs.append(str(e))
+        return None
+    return to_image(pyxelated, args.scaling)
+
+def save_image(outfile, pyxelated):
+    """Save the image, paletted images are written by Pillow as 8 bit PNGs"""
+    pyxelated.save(outfile)
+
+def save_recorded(outfile, pyxelated):
+    """Save the image in the background thread, returning the messages
+    of its warnings"""
+    warns = []
+    record_warnings(warns, save_image, outfile, pyxelated)
+    return warns
+
+def process_one(image_file, outfile, args):
+    """Convert and save a single image, returning the elapsed time,
+    the status of the conversion, the messages of warnings and errors,
+    and None as there is no save left to wait for"""
+    img_start = t.time()
+    warns, errs = [], []
+
+    image = record_warnings(warns, read_image, image_file)
+    if image is None:
+        return t.time() - img_start, "unsupported", warns, errs, None
+
+    pyxelated = convert_image(image, args, warns, errs)
+    if pyxelated is None:
+        return t.time() - img_start, "error", warns, errs, None
+
+    # Finally save the image
+    try:
+        record_warnings(warns, save_image, outfile, pyxelated)
+    except Exception as e:
+        errs.append(str(e))
+        return t.time() - img_start, "error", warns, errs, None
+
+    return t.time() - img_start, "done", warns, errs, None
+
+def process_serial(jobs, args):
+    """Convert images one after another in the current process, yielding
+    the same results as process_one. The next file is read and the
+    image is saved in background threads, so every result comes with the
+    future of its save instead of None"""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        read_future = pool.submit(prefetch_image, jobs[0][0])
+        for i, (image_file, outfile, *_) in enumerate(jobs):
+            img_start = t.time()
+            warns, errs = [], []
+
+            read_future.result()
+            image = record_warnings(warns, read_image, image_file)
+            if i + 1 < len(jobs):
+                read_future = pool.submit(prefetch_image, jobs[i + 1][0])
+
+            write_future = None
+            if image is None:
+                status = "unsupported"
+            else:
+                pyxelated = convert_image(image, args, warns, errs)
+                if pyxelated is None:
+                    status = "error"
+                else:
+                    status = "done"
+                    write_future = pool.submit(save_recorded, outfile,
+                        pyxelated)
+
+            yield t.time() - img_start, status, warns, errs, write_future
+
+def report_save(s_path, s_name, write_future):
+    """Wait for an image to be saved in the background thread, and print
+    its warnings, or the error if that failed"""
+    global cur_file, warn_cnt, err_cnt
+    try:
+        warns = write_future.result()
+    except Exception as e:
+        print(bar_rmv + "\tSaving " + red("failed") + ":\t" +
+            dim(s_path) + s_name + ".png")
+        err_cnt += 1
+        print_err(e, s_name + ".png")
+        # The image was counted as done when it was converted
+        cur_file -= 1
+        return
+
+    if warns and args.warnings:
+        print(bar_rmv + "\tSaving image:\t" + dim(s_path) + s_name + ".png")
+    for e in warns:
+        warn_cnt += 1
+        print_warn(e, s_name + ".png")
+
 
 if __name__ == "__main__":
     # Get arguments and file list
@@ -247,93 +487,81 @@ if __name__ == "__main__":
     else:
         print("Reading files from " + dim(str(Path.cwd())) + "/" + str(input_dir))
 
-    # Height and width are getting set per image, this are just placeholders
-    p = Pyxelate(1, 1, color=args.colors, dither=args.dither,
-        alpha=args.alpha, regenerate_palette=args.regenerate_palette,
-        random_state=args.random_state)
-
-    # Loop over all images in the directory
-    for image_file in image_files:
-        # Get the path, file name, and extension
-        base = str(image_file.stem) + ".png"
-        outfile = output_dir / base
-        f_path, f_name, f_ext = parse_path(image_file)
-
-        # Get the time of the last iteration to calculate the remaining
-        if 'img_end' in globals():
-            if len(time_img) == avg_last_vals:
-                del time_img[0]
-                time_img.append(round(img_end - img_start, 1))
-            else:
-                time_img.append(round(img_end - img_start, 1))
-        img_start = t.time()
-
-        # The file format must be supported by skimage
-        try:
-            image = io.imread(image_file)
-        except ValueError:
-            # When the file is not an image just move to the next file
-            print(bar_rmv + "\tSkipping " + red("unsupported") +
-                ":\t" + dim(f_path) + f_name + '.' + red(f_ext))
-            bar_redraw()
-            continue
-
-        print(bar_rmv + "\tProcessing image:\t" + dim(f_path) +
-            f_name + '.' + f_ext)
-
-        # Redraw status bar
-        bar_redraw()
-
-        # Get image dimensions
-        height, width, _ = image.shape
-
-        # Apply the dimensions to Pyxelate
-        p.height = height // args.factor
-        p.width = width // args.factor
-
-        try:
-            warnings.filterwarnings("error")
-            pyxelated = p.convert(image)
-        except KeyboardInterrupt:
-            print(bar_rmv + "Cancelled with " + red("Ctrl+C"))
-            bar_redraw(1)
-            sys.exit(0)
-        except IndexError as e:
-            # When the file is not an image just move to the next file
-            err_cnt += 1
-            print_err(e)
+    # Get the output file, and the path, file name, and extension
+    # of every input file for printing them
+    input_root = str(Path(args.input))
+    jobs = [(f, output_dir / (str(f.stem) + ".png"), *parse_path(f, input_root))
+        for f in image_files]
+
+    # Images are independent from each other, so they can be converted
+    # in parallel, unless all of them have to share the same palette
+    if args.jobs == 0:
+        print(red("0") + " jobs can not convert any images.")
+        sys.exit(1)
+    if all_files > 1 and args.regenerate_palette:
+        workers = min(effective_n_jobs(args.jobs), all_files)
+    if workers > 1:
+        # The loky workers are reused, and they limit their own BLAS threads
+        parallel = Parallel(n_jobs=workers, backend="loky",
+            return_as="generator")
+        results = parallel(delayed(process_one)(image_file, outfile, args)
+            for image_file, outfile, *_ in jobs)
+    else:
+        results = process_serial(jobs, args)
+
+    # Loop over the results in the order of the files
+    # Path and name of the last image, and the future of its save
+    saving = None
+    try:
+        for (_, _, f_path, f_name, f_ext), result in zip(jobs, results):
+            elapsed, status, warns, errs, write_future = result
+
+            # The last image has been saved while this one was converted
+            if saving is not None:
+                report_save(*saving)
+                saving = None
+
+            if status == "unsupported":
+                # When the file is not an image just move to the next file
+                print(bar_rmv + "\tSkipping " + red("unsupported") +
+                    ":\t" + dim(f_path) + f_name + '.' + red(f_ext))
+                bar_redraw()
+                continue
+
+            # Results arrive once an image is converted, on both paths
+            print(bar_rmv + "\tFinished image:\t" + dim(f_path) +
+                f_name + '.' + f_ext)
+
+            for e in warns:
+                warn_cnt += 1
+                print_warn(e)
+            for e in errs:
+                err_cnt += 1
+                print_err(e)
+
+            # Only count up if the image was successfully processed
+            if status == "done":
+                # Keep the time of the last iterations to calculate the remaining
+                elapsed = round(elapsed, 1)
+                if len(time_img) == avg_last_vals:
+                    time_sum -= time_img[0]
+                time_img.append(elapsed)
+                time_sum += elapsed
+                cur_file += 1
+            if write_future is not None:
+                saving = (f_path, f_name, write_future)
+
+            # Redraw status bar
             bar_redraw()
-            continue
-        except BaseException as e:
-            warn_cnt += 1
-            print_warn(e)
-            warnings.filterwarnings("ignore")
-            pyxelated = p.convert(image)
-
-        # Scale the image up if so requested
-        if args.scaling > 1:
-            pyxelated = transform.resize(pyxelated, (
-                (height // args.factor) * args.scaling,
-                (width // args.factor) * args.scaling),
-                anti_aliasing=False, mode='edge',
-                preserve_range=True, order=0
-            )
-
-        # Finally save the image
-        try:
-            warnings.filterwarnings("error")
-            io.imsave(outfile, pyxelated.astype(uint8))
-        except KeyboardInterrupt:
-            print(bar_rmv + "Cancelled with " + red("Ctrl+C"))
-            bar_redraw(1)
-            sys.exit(0)
-        except BaseException as e:
-            warn_cnt += 1
-            print_warn(e)
-            warnings.filterwarnings("ignore")
-            io.imsave(outfile, pyxelated.astype(uint8))
-
-        img_end = t.time()
-        cur_file += 1 # Only count up if the image was successfully processed
+
+        if saving is not None:
+            report_save(*saving)
+    except KeyboardInterrupt:
+        print(bar_rmv + "Cancelled with " + red("Ctrl+C"))
+        bar_redraw(1)
+        sys.exit(0)
+    finally:
+        # Stops the remaining conversions when cancelled
+        results.close()
 
     bar_redraw(1)
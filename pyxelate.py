@@ -10,6 +10,7 @@ from skimage.exposure import equalize_adapthist
 from skimage.transform import resize
 
 from sklearn.mixture import BayesianGaussianMixture
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.exceptions import ConvergenceWarning
 
 __version__ = '1.2.0'
@@ -66,8 +67,12 @@ class Pyxelate:
 
 	ITER = 2
 
+	QUANTIZERS = ("bgmm", "kmeans")
+
+	LUT_BITS = 5  # bits per channel of the color lookup table
+
 	def __init__(self, height, width, color=8, dither=True, alpha=.6, regenerate_palette=True,
-				 keyframe=.6, sensitivity=.07, random_state=0):
+				 keyframe=.6, sensitivity=.07, random_state=0, quantizer="bgmm"):
 		"""Create instance for generating similar pixel arts."""
 		self.height = int(height)
 		self.width = int(width)
@@ -87,16 +92,26 @@ class Pyxelate:
 		self.keyframe = keyframe  # threshold for differences between keyframes
 		self.sensitivity = sensitivity  # threshold for differences between parts of keyframes
 
-		# BGM
+		# BGM or K-means
 		self.is_fitted = False
+		self.lut = None
 		self.random_state = int(random_state)
-		self.model = BayesianGaussianMixture(n_components=self.color,
-											 max_iter=256,
-											 covariance_type="tied",
-											 weight_concentration_prior_type="dirichlet_distribution",
-											 mean_precision_prior=1. / 256.,
-											 warm_start=False,
-											 random_state=self.random_state)
+		self.quantizer = str(quantizer).lower()
+		if self.quantizer == "bgmm":
+			self.model = BayesianGaussianMixture(n_components=self.color,
+												 max_iter=256,
+												 covariance_type="tied",
+												 weight_concentration_prior_type="dirichlet_distribution",
+												 mean_precision_prior=1. / 256.,
+												 warm_start=False,
+												 random_state=self.random_state)
+		elif self.quantizer == "kmeans":
+			self.model = MiniBatchKMeans(n_clusters=self.color,
+										 batch_size=4096,
+										 n_init=3,
+										 random_state=self.random_state)
+		else:
+			raise ValueError(f"The quantizer must be one of: {', '.join(self.QUANTIZERS)}.")
 
 	def convert(self, image):
 		"""Generate pixel art from image"""
@@ -136,20 +151,25 @@ class Pyxelate:
 		# apply palette
 		height, width, depth = image.shape
 		reshaped = np.reshape(image, (height * width, depth))
-		probs = self.model.predict_proba(reshaped)
-		y = np.argmax(probs, axis=1)
+		dither = not override_dither and self.dither
+		if dither:
+			probs = self._predict_proba(reshaped)
+			y = np.argmax(probs, axis=1)
+		else:
+			y = self._predict(reshaped)
 
 		# increase hue and snap color values to multiples of 8
-		palette = rgb2hsv(self.model.means_.reshape(-1, 1, 3))
+		palette = rgb2hsv(self._means().reshape(-1, 1, 3))
 		palette[:, :, 1] *= 1.14  # empirical magic number
 		palette = hsv2rgb(palette).reshape(self.color, 3) // 8 * 8
 		palette[palette == 248] = 255  # clamping // 8 * 8 would rarely allow 255 values
+		palette = np.clip(palette, 0, 255).astype("uint8")
 
 		# generate recolored image
 		image = palette[y]
 
 		# apply dither over threshold if it's not zero
-		if not override_dither and self.dither:
+		if dither:
 			# get second best probability by removing the best one
 			probs[np.arange(len(y)), y] = 0
 			# get new best and values
@@ -157,33 +177,23 @@ class Pyxelate:
 			y = np.argmax(probs, axis=1)
 
 			# replace every second pixel with second best color
-			pad = not bool(width % 2)
-			if pad:
-				# make sure to alternate between starting positions
-				# bottleneck
-				for i in range(0, len(image), 2):
-					i += (i // width) % 2
-					if v[i]:
-						image[i] = palette[y[i]]
-			else:
-				i = np.argwhere(v[::2]) * 2
-				image[i] = palette[y[i]]
+			# alternating between starting positions in each row, like a checkerboard
+			checkerboard = (np.indices((height, width)).sum(axis=0) % 2 == 0).ravel()
+			i = np.logical_and(v, checkerboard)
+			image[i] = palette[y[i]]
 
 		image = np.reshape(image, (height, width, depth))
 		if mask is not None:
 			# use transparency from original image, but make it either 0 or 255
-			mask[mask >= self.alpha] = 255
-			mask[mask < self.alpha] = 0
+			mask = np.where(mask >= self.alpha, np.uint8(255), np.uint8(0))
 			image = np.dstack((image, mask))  # result has lost its alpha channel
 
-		return np.clip(image.astype("int"), 0, 255).astype("uint8")
+		return image
 
 	def convert_sequence(self, images):
 		"""Generates sequence of pixel arts from a list of images"""
-		try:
-			_ = np.array(images, dtype=float)
-		except ValueError:
-			# image sizes are different == setting an array element with a sequence
+		# compare the shapes only, instead of copying every image into a float array
+		if len(set(np.shape(image) for image in images)) > 1:
 			raise ValueError("Shape of images in list are different.")
 
 		# apply adaptive histogram on each
@@ -271,6 +281,43 @@ class Pyxelate:
 		if not converge:
 			warnings.warn("the model has failed to converge, try a different number of colors for better results!", Warning)
 		self.is_fitted = True
+		self.lut = None
+
+	def _predict_proba(self, X):
+		"""Probability of each color of the palette for every sample"""
+		if self.quantizer == "bgmm":
+			return self.model.predict_proba(X)
+		# K-means has no probabilities, treat the clusters as gaussians with a shared variance instead
+		# squared distances from the centers are summed channel by channel over contiguous planes
+		# color values are within a few hundreds, so single precision halves the memory traffic without losing accuracy
+		planes = np.ascontiguousarray(np.transpose(X), dtype="float32")
+		centers = self.model.cluster_centers_.astype("float32")
+		dist = (planes[0] - centers[:, 0, None]) ** 2
+		for c in range(1, len(planes)):
+			dist += (planes[c] - centers[:, c, None]) ** 2
+		variance = max(float(np.mean(np.min(dist, axis=0))) / len(planes), 1e-8)
+		log_probs = dist / np.float32(-2. * variance)
+		probs = np.exp(log_probs - np.max(log_probs, axis=0))
+		return np.transpose(probs / np.sum(probs, axis=0))
+
+	def _predict(self, X):
+		"""Index of the most probable color of the palette for every sample"""
+		size = 2 ** self.LUT_BITS
+		if len(X) <= size ** 3:
+			return np.argmax(self._predict_proba(X), axis=1)
+		# for larger images it is cheaper to predict the centers of a coarse RGB cube once, and look up the colors
+		if self.lut is None:
+			step = 2 ** (8 - self.LUT_BITS)
+			grid = np.indices((size, size, size)).reshape(3, -1).T * step + step // 2
+			self.lut = np.argmax(self._predict_proba(grid), axis=1).astype("uint8").reshape(size, size, size)
+		X = np.clip(X, 0, 255).astype("uint8") >> (8 - self.LUT_BITS)
+		return self.lut[X[:, 0], X[:, 1], X[:, 2]]
+
+	def _means(self):
+		"""Colors of the palette before adjustments"""
+		if self.quantizer == "bgmm":
+			return self.model.means_
+		return self.model.cluster_centers_
 
 	def _reduce(self, image):
 		"""Apply convolutions on image ITER times and generate a smaller image
@@ -284,9 +331,8 @@ class Pyxelate:
 			for n in range(self.ITER):
 				h, w = dim.shape
 				h, w = h // 2, w // 2
-				flatten = view_as_blocks(dim, (2, 2)).reshape(-1, 2, 2)
-				# bottleneck
-				new_image = np.fromiter((self._reduce_conv(f) for f in flatten), flatten.dtype).reshape((h, w))
+				flatten = view_as_blocks(dim, (2, 2)).reshape(-1, 4)
+				new_image = self._reduce_conv(flatten).reshape((h, w))
 				if n < self.ITER - 1:
 					dim = new_image.copy()
 			return new_image
@@ -294,9 +340,14 @@ class Pyxelate:
 		return _wrapper(image)
 
 	def _reduce_conv(self, f):
-		"""The actual function that selects the right pixels based on the gradients  2x2 square"""
-		return np.mean(f[self.SOLUTIONS[
-			np.argmax(np.sum(np.multiply(self.CONVOLUTIONS, f.reshape(-1, 2, 2)).reshape(-1, 4), axis=1))]])
+		"""The actual function that selects the right pixels based on the gradients of every flattened 2x2 square"""
+		convolutions = self.CONVOLUTIONS.reshape(-1, 4)
+		# sum the products in order, so that ties between gradients are resolved the same way for every square
+		gradients = f[:, :1] * convolutions[:, 0]
+		for i in range(1, 4):
+			gradients += f[:, i:i + 1] * convolutions[:, i]
+		solutions = self.SOLUTIONS.reshape(-1, 4)[np.argmax(gradients, axis=1)]
+		return np.sum(f * solutions, axis=1) / np.sum(solutions, axis=1)
 
 	def _dilate(self, image):
 		"""Dilate semi-transparent edges to remove artifacts
@@ -9,6 +9,6 @@ setup(name='pyxelate',
       packages=[''],
       zip_safe=False,
       install_requires=[
-          'scikit-image==0.16.2', 'scikit-learn==0.22.1'
+          'scikit-image==0.16.2', 'scikit-learn==0.22.1', 'Pillow>=4.3.0', 'joblib>=1.3.0'
       ],
       )